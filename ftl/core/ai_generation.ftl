@@ -61,6 +61,7 @@ ai-generation-error-empty-text = Please paste some text before generating.
 ai-generation-error-empty-url = Please enter a URL before generating.
 ai-generation-error-missing-file = Please choose a file before generating.
 ai-generation-error-empty-file = The selected file was empty.
+ai-generation-error-file-too-large = The selected file is too large. Please choose a file under { $megabytes } MB.
 ai-generation-error-missing-notetype = Select a note type for the generated cards.
 ai-generation-error-invalid-notetype = The selected note type could not be loaded.
 
@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 
+import hashlib
 from collections.abc import Iterable
 from dataclasses import dataclass
 from html import escape
@@ -10,15 +11,17 @@ from typing import Dict, List, Optional
 
 import aqt.forms
 from anki import ai_generation_pb2 as ai_pb
-from anki.collection import AddNoteRequest
+from anki.collection import AddNoteRequest, Collection
 from anki.decks import DeckId
 from anki.errors import AnkiError
+from anki.models import NotetypeDict
 from anki.notes import Note
 from anki.utils import strip_html
-from aqt import AnkiQt
+from aqt import AnkiQt, gui_hooks
 from aqt.operations import CollectionOp, QueryOp
 from aqt.qt import *
 from aqt.utils import (
+    no_arg_trigger,
     openFile,
     restoreGeom,
     saveGeom,
@@ -42,6 +45,9 @@ DEFAULT_MODELS: dict[int, str] = {
     ai_pb.Provider.PROVIDER_PERPLEXITY: "sonar-reasoning",
 }
 
+# larger files are rejected before being read into memory
+MAX_FILE_BYTES = 20 * 1024 * 1024
+
 
 @dataclass
 class PreviewNote:
@@ -51,6 +57,26 @@ class PreviewNote:
     display_source: str
 
 
+@dataclass
+class FieldLayout:
+    """Lowercased field names of a notetype, computed once per batch of adds."""
+
+    fields: List[tuple[int, str]]
+    back_index: Optional[int]
+    source_index: Optional[int]
+
+    @classmethod
+    def from_notetype(cls, notetype: NotetypeDict) -> FieldLayout:
+        fields = [
+            (idx, field["name"].lower()) for idx, field in enumerate(notetype["flds"])
+        ]
+        return cls(
+            fields=fields,
+            back_index=next((idx for idx, name in fields if name == "back"), None),
+            source_index=next((idx for idx, name in fields if name == "source"), None),
+        )
+
+
 class AiGeneratorDialog(QDialog):
     def __init__(
         self,
@@ -70,6 +96,8 @@ class AiGeneratorDialog(QDialog):
         self._deck_ids: Dict[int, int] = {}
         self._models_cache: Dict[int, List[str]] = {}
         self._selected_models: Dict[int, str] = {}
+        self._pending_model_text: Optional[tuple[int, str]] = None
+        self._last_config_digest: Optional[bytes] = None
         self._file_path: Optional[Path] = None
         self._requested_note_type_id = note_type_id
         self._requested_deck_id = deck_id
@@ -79,6 +107,11 @@ class AiGeneratorDialog(QDialog):
         self._load_note_types()
         self._load_decks()
 
+        # a one-way sync, colpkg import or profile switch replaces the stored
+        # config; aqt.dialogs keeps this dialog alive, so the hooks stay attached
+        gui_hooks.collection_did_temporarily_close.append(self._forget_saved_config)
+        gui_hooks.collection_did_load.append(self._forget_saved_config)
+
         restoreGeom(self, "aiGenerator")
         self.show()
 
@@ -136,16 +169,24 @@ class AiGeneratorDialog(QDialog):
         self.form.previewTree.setSelectionMode(
             QAbstractItemView.SelectionMode.ExtendedSelection
         )
+        # signals are only connected here, from __init__; aqt.dialogs reuses the
+        # open instance, so no connection is ever made twice
         self.form.previewTree.itemSelectionChanged.connect(self._update_add_buttons)
 
         self.form.generateButton.clicked.connect(self._on_generate_clicked)
         self.form.clearButton.clicked.connect(self._on_clear_clicked)
         self.form.addAllButton.clicked.connect(self._on_add_all)
         self.form.addSelectedButton.clicked.connect(self._on_add_selected)
-        self.form.buttonBox.rejected.connect(self.reject)
+        self.form.buttonBox.rejected.connect(
+            self.reject, Qt.ConnectionType.DirectConnection
+        )
 
-        self.form.providerCombo.currentIndexChanged.connect(self._on_provider_changed)
-        self.form.useDefaultNoteType.toggled.connect(self._on_default_notetype_toggled)
+        self.form.providerCombo.currentIndexChanged[int].connect(
+            self._on_provider_changed
+        )
+        self.form.useDefaultNoteType.toggled[bool].connect(
+            self._on_default_notetype_toggled
+        )
         self.form.browseButton.clicked.connect(self._on_browse_file)
         self.form.fetchButton.setVisible(False)
         self.form.urlPreview.setVisible(False)
@@ -161,7 +202,13 @@ class AiGeneratorDialog(QDialog):
         combo.setDuplicatesEnabled(False)
         combo.setEditable(True)
         combo.lineEdit().setClearButtonEnabled(True)
-        combo.editTextChanged.connect(self._on_model_text_changed)
+        combo.editTextChanged[str].connect(self._on_model_text_changed)
+
+        # only record the model once typing has settled
+        self._model_text_timer = QTimer(self)
+        self._model_text_timer.setSingleShot(True)
+        self._model_text_timer.setInterval(150)
+        self._model_text_timer.timeout.connect(self._commit_model_text)
 
         self._api_key_inputs = {
             ai_pb.Provider.PROVIDER_GEMINI: self.form.geminiKey,
@@ -209,18 +256,15 @@ class AiGeneratorDialog(QDialog):
             else self._selected_models.get(provider, "")
         )
         source = models if models is not None else self._models_cache.get(provider, [])
-        unique: List[str] = []
-        seen: set[str] = set()
-        for model in source or []:
-            trimmed = model.strip()
-            if trimmed and trimmed not in seen:
-                unique.append(trimmed)
-                seen.add(trimmed)
+        unique = list(
+            dict.fromkeys(
+                trimmed for trimmed in (m.strip() for m in source or []) if trimmed
+            )
+        )
 
         combo.blockSignals(True)
         combo.clear()
-        for model in unique:
-            combo.addItem(model)
+        combo.addItems(unique)
         combo.setEditText(current_text or "")
         combo.blockSignals(False)
 
@@ -229,14 +273,25 @@ class AiGeneratorDialog(QDialog):
 
         self._set_model_placeholder(DEFAULT_MODELS.get(provider, ""))
 
+    @pyqtSlot(str)  # type: ignore
     def _on_model_text_changed(self, text: str) -> None:
-        provider = self.current_provider()
+        self._pending_model_text = (self.current_provider(), text)
+        self._model_text_timer.start()
+
+    @no_arg_trigger
+    def _commit_model_text(self) -> None:
+        self._model_text_timer.stop()
+        if self._pending_model_text is None:
+            return
+        provider, text = self._pending_model_text
+        self._pending_model_text = None
         stripped = text.strip()
         if stripped:
             self._selected_models[provider] = stripped
         else:
             self._selected_models.pop(provider, None)
 
+    @no_arg_trigger
     def _on_refresh_models(self) -> None:
         provider = self.current_provider()
         request = ai_pb.ListModelsRequest()
@@ -319,12 +374,9 @@ class AiGeneratorDialog(QDialog):
             self.form.useDefaultNoteType.setChecked(False)
 
     def _load_note_types(self) -> None:
-        self.form.noteTypeCombo.clear()
-        self._note_type_ids.clear()
         note_types = self.mw.col.models.all_names_and_ids()
-        for idx, entry in enumerate(note_types):
-            self.form.noteTypeCombo.addItem(entry.name, entry.id)
-            self._note_type_ids[idx] = entry.id
+        self._note_type_ids = {idx: entry.id for idx, entry in enumerate(note_types)}
+        self._fill_combo(self.form.noteTypeCombo, [(e.name, e.id) for e in note_types])
 
         # choose default: current note type or saved default
         current_ntid = self.mw.col.models.current()["id"]
@@ -342,12 +394,9 @@ class AiGeneratorDialog(QDialog):
             self.form.noteTypeCombo.setCurrentIndex(combo_index)
 
     def _load_decks(self) -> None:
-        self.form.deckCombo.clear()
-        self._deck_ids.clear()
         decks = self.mw.col.decks.all_names_and_ids()
-        for idx, entry in enumerate(decks):
-            self.form.deckCombo.addItem(entry.name, entry.id)
-            self._deck_ids[idx] = entry.id
+        self._deck_ids = {idx: entry.id for idx, entry in enumerate(decks)}
+        self._fill_combo(self.form.deckCombo, [(e.name, e.id) for e in decks])
 
         current_deck = int(
             self._requested_deck_id or self.mw.col.decks.get_current_id()
@@ -356,18 +405,33 @@ class AiGeneratorDialog(QDialog):
         if combo_index != -1:
             self.form.deckCombo.setCurrentIndex(combo_index)
 
+    def _fill_combo(self, combo: QComboBox, entries: List[tuple[str, int]]) -> None:
+        combo.blockSignals(True)
+        try:
+            combo.clear()
+            combo.addItems([name for name, _ in entries])
+            for idx, (_, item_id) in enumerate(entries):
+                combo.setItemData(idx, item_id)
+        finally:
+            combo.blockSignals(False)
+
     # ------------------------------------------------------------------
     # Event handlers
     # ------------------------------------------------------------------
 
-    def _on_provider_changed(self) -> None:
+    @pyqtSlot(int)  # type: ignore
+    def _on_provider_changed(self, _index: int = 0) -> None:
+        # store any edit made for the previous provider before switching
+        self._commit_model_text()
         provider = self.current_provider()
         self._set_model_placeholder(DEFAULT_MODELS.get(provider, ""))
         self._populate_model_combo(provider, preserve_current=False)
 
+    @pyqtSlot(bool)  # type: ignore
     def _on_default_notetype_toggled(self, checked: bool) -> None:
         self.form.noteTypeCombo.setEnabled(not checked)
 
+    @no_arg_trigger
     def _on_browse_file(self) -> None:
         path = openFile(
             parent=self,
@@ -379,6 +443,7 @@ class AiGeneratorDialog(QDialog):
             self._file_path = Path(path)
             self.form.filePathInput.setText(str(self._file_path))
 
+    @no_arg_trigger
     def _on_generate_clicked(self) -> None:
         try:
             request = self._build_request()
@@ -387,43 +452,76 @@ class AiGeneratorDialog(QDialog):
             showInfo(str(exc), parent=self)
             return
 
+        # don't resave the config if nothing changed since the last successful save;
+        # only a digest is kept, as the request includes the API keys
+        config_digest = hashlib.sha256(config_request.SerializeToString()).digest()
+        save_config = config_digest != self._last_config_digest
+
+        file_path = (
+            self._file_path
+            if request.input_type == ai_pb.InputType.INPUT_TYPE_FILE
+            else None
+        )
         self._set_busy(True)
 
-        def op(col) -> ai_pb.GenerateFlashcardsResponse:
-            if config_request:
+        def op(col) -> List[PreviewNote]:
+            if file_path:
+                with file_path.open("rb") as file:
+                    request.file.data = file.read()
+                if not request.file.data:
+                    raise AnkiError(tr.ai_generation_error_empty_file())
+            if save_config:
                 col.set_ai_generation_config(config_request)
-            return col.generate_flashcards(request)
+            # prepare the display strings here rather than on the GUI thread
+            return self._build_preview_notes(col.generate_flashcards(request))
 
         (
-            QueryOp(parent=self, op=op, success=self._on_generate_finished)
+            QueryOp(
+                parent=self,
+                op=op,
+                success=lambda notes: self._on_generate_finished(
+                    notes, config_digest if save_config else None
+                ),
+            )
             .failure(self._on_generate_failed)
             .with_progress(tr.ai_generation_progress_generating())
         ).run_in_background()
 
-    def _on_generate_finished(self, response: ai_pb.GenerateFlashcardsResponse) -> None:
+    def _on_generate_finished(
+        self, notes: List[PreviewNote], saved_config_digest: Optional[bytes] = None
+    ) -> None:
         self._set_busy(False)
-        self._populate_preview(response)
+        if saved_config_digest is not None:
+            self._last_config_digest = saved_config_digest
+        self._set_preview_notes(notes)
         self._reset_api_key_fields()
 
-        if not response.notes:
+        if not notes:
             showInfo(tr.ai_generation_no_cards_returned(), parent=self)
 
+    def _forget_saved_config(self, col: Collection) -> None:
+        self._last_config_digest = None
+
     def _on_generate_failed(self, error: Exception) -> None:
         self._set_busy(False)
         showException(parent=self, exception=error)
 
+    @no_arg_trigger
     def _on_add_all(self) -> None:
         self._add_notes(range(len(self._generated_notes)))
 
+    @no_arg_trigger
     def _on_add_selected(self) -> None:
-        indices = []
-        for item in self.form.previewTree.selectedItems():
-            idx = item.data(0, Qt.ItemDataRole.UserRole)
-            if isinstance(idx, int):
-                indices.append(idx)
+        user_role = Qt.ItemDataRole.UserRole
+        indices = [
+            idx
+            for item in self.form.previewTree.selectedItems()
+            if isinstance(idx := item.data(0, user_role), int)
+        ]
         if indices:
             self._add_notes(indices)
 
+    @no_arg_trigger
     def _on_clear_clicked(self) -> None:
         self.form.textInput.clear()
         self.form.urlInput.clear()
@@ -468,14 +566,21 @@ class AiGeneratorDialog(QDialog):
         else:
             if not self._file_path:
                 raise AnkiError(tr.ai_generation_error_missing_file())
-            data = self._file_path.read_bytes()
-            if not data:
+            try:
+                size = self._file_path.stat().st_size
+            except OSError as exc:
+                raise AnkiError(str(exc)) from exc
+            if not size:
                 raise AnkiError(tr.ai_generation_error_empty_file())
-            file_input = ai_pb.FileInput()
-            file_input.filename = self._file_path.name
-            file_input.data = data
+            if size > MAX_FILE_BYTES:
+                raise AnkiError(
+                    tr.ai_generation_error_file_too_large(
+                        megabytes=MAX_FILE_BYTES // (1024 * 1024)
+                    )
+                )
+            # the contents are read in the background by _on_generate_clicked
             request.input_type = ai_pb.InputType.INPUT_TYPE_FILE
-            request.file.CopyFrom(file_input)
+            request.file.filename = self._file_path.name
 
         request.max_cards = self.form.maxCardsSpin.value()
 
@@ -519,59 +624,66 @@ class AiGeneratorDialog(QDialog):
             self._selected_models.pop(config.selected_provider, None)
         config.default_max_cards = self.form.maxCardsSpin.value()
 
-        config.api_keys.extend(self._collect_api_keys())
+        self._populate_api_keys(config)
 
         request = ai_pb.SetAiConfigRequest()
         request.config.CopyFrom(config)
         request.persist_api_keys = True
         return request
 
-    def _collect_api_keys(self) -> Iterable[ai_pb.ProviderApiKey]:
+    def _populate_api_keys(self, config: ai_pb.AiGenerationConfig) -> None:
         for provider, line_edit in self._api_key_inputs.items():
+            entry = config.api_keys.add()
+            entry.provider = provider
             text = line_edit.text().strip()
             if text:
-                yield ai_pb.ProviderApiKey(
-                    provider=provider,
-                    api_key=text,
-                    masked=False,
-                )
+                entry.api_key = text
             elif self._provider_masked.get(provider, False):
-                yield ai_pb.ProviderApiKey(provider=provider, masked=True)
+                entry.masked = True
             else:
-                yield ai_pb.ProviderApiKey(provider=provider, api_key="", masked=False)
+                # sent as present-but-empty, unlike masked entries
+                entry.api_key = ""
 
     def _reset_api_key_fields(self) -> None:
+        saved_placeholder = tr.ai_generation_saved_api_key_placeholder()
         for provider, widget in self._api_key_inputs.items():
-            text = widget.text().strip()
-            if text:
-                self._provider_masked[provider] = True
-                widget.clear()
-                widget.setPlaceholderText(tr.ai_generation_saved_api_key_placeholder())
-
-    def _populate_preview(self, response: ai_pb.GenerateFlashcardsResponse) -> None:
-        preview_notes = []
-        for proto in response.notes:
-            preview_notes.append(
-                PreviewNote(
-                    proto=proto,
-                    display_front=self._display_field(
-                        proto, ["front", "question", "prompt"]
-                    ),
-                    display_back=self._display_field(
-                        proto, ["back", "answer", "response"]
-                    ),
-                    display_source=self._display_source(proto.source),
-                )
+            if not widget.text().strip():
+                continue
+            self._provider_masked[provider] = True
+            widget.clear()
+            widget.setPlaceholderText(saved_placeholder)
+
+    def _build_preview_notes(
+        self, response: ai_pb.GenerateFlashcardsResponse
+    ) -> List[PreviewNote]:
+        display_field = self._display_field
+        display_source = self._display_source
+        front_names = ["front", "question", "prompt"]
+        back_names = ["back", "answer", "response"]
+        return [
+            PreviewNote(
+                proto=proto,
+                display_front=display_field(proto, front_names),
+                display_back=display_field(proto, back_names),
+                display_source=display_source(proto.source),
             )
-        self._set_preview_notes(preview_notes)
+            for proto in response.notes
+        ]
 
     def _display_field(
         self, proto: ai_pb.GeneratedNote, preferred_names: List[str]
     ) -> str:
-        mapping = {field.name.lower(): field.value for field in proto.fields}
-        for name in preferred_names:
-            if name in mapping:
-                return strip_html(mapping[name])
+        # single pass; like the field map in _create_note, a later field with
+        # the same name wins
+        rank = {name: i for i, name in enumerate(preferred_names)}
+        best_rank = len(preferred_names)
+        best_value: Optional[str] = None
+        for field in proto.fields:
+            i = rank.get(field.name.lower())
+            if i is not None and i <= best_rank:
+                best_rank, best_value = i, field.value
+        if best_value is not None:
+            return strip_html(best_value)
         if proto.fields:
             return strip_html(proto.fields[0].value)
         return ""
@@ -591,16 +703,28 @@ class AiGeneratorDialog(QDialog):
 
     def _set_preview_notes(self, notes: List[PreviewNote]) -> None:
         self._generated_notes = list(notes)
-        tree = self.form.previewTree
-        tree.clear()
+        items: List[QTreeWidgetItem] = []
         for idx, note in enumerate(notes):
-            item = QTreeWidgetItem(tree)
+            item = QTreeWidgetItem()
             item.setText(0, note.display_front)
             item.setText(1, note.display_back)
             item.setText(2, note.display_source)
             item.setData(0, Qt.ItemDataRole.UserRole, idx)
+            items.append(item)
+
+        # insert in one go rather than relayouting after every item
+        tree = self.form.previewTree
+        tree.setUpdatesEnabled(False)
+        tree.blockSignals(True)
+        try:
+            tree.clear()
+            tree.addTopLevelItems(items)
+        finally:
+            tree.blockSignals(False)
+            tree.setUpdatesEnabled(True)
         self._update_add_buttons()
 
+    @no_arg_trigger
     def _update_add_buttons(self) -> None:
         has_notes = bool(self._generated_notes)
         self.form.addAllButton.setEnabled(has_notes)
@@ -619,17 +743,21 @@ class AiGeneratorDialog(QDialog):
     # ------------------------------------------------------------------
 
     def _add_notes(self, indices: Iterable[int]) -> None:
-        unique_indices = sorted(set(indices), reverse=True)
+        count = len(self._generated_notes)
+        unique_indices = frozenset(i for i in indices if 0 <= i < count)
         if not unique_indices:
             return
 
         requests: List[AddNoteRequest] = []
-        for index in unique_indices:
-            if index >= len(self._generated_notes):
+        notetypes: Dict[int, Optional[NotetypeDict]] = {}
+        layouts: Dict[int, FieldLayout] = {}
+        # walk the previews rather than the set, so notes are added in order
+        for index, preview in enumerate(self._generated_notes):
+            if index not in unique_indices:
                 continue
-            proto = self._generated_notes[index].proto
+            proto = preview.proto
             try:
-                note, deck_id = self._create_note(proto)
+                note, deck_id = self._create_note(proto, notetypes, layouts)
             except AnkiError as err:
                 showInfo(str(err), parent=self)
                 return
@@ -646,7 +774,12 @@ class AiGeneratorDialog(QDialog):
             ).failure(self._on_add_failure)
         ).run_in_background(initiator=self)
 
-    def _create_note(self, proto: ai_pb.GeneratedNote) -> tuple[Note, DeckId]:
+    def _create_note(
+        self,
+        proto: ai_pb.GeneratedNote,
+        notetypes: Dict[int, Optional[NotetypeDict]],
+        layouts: Dict[int, FieldLayout],
+    ) -> tuple[Note, DeckId]:
         notetype_id = proto.note_type_id or self._effective_note_type_id()
         if not notetype_id:
             raise AnkiError(tr.ai_generation_error_missing_notetype())
@@ -655,32 +788,30 @@ class AiGeneratorDialog(QDialog):
         if not deck_id:
             deck_id = int(self.mw.col.decks.get_current_id())
 
-        notetype = self.mw.col.models.get(notetype_id)
+        if notetype_id in notetypes:
+            notetype = notetypes[notetype_id]
+        else:
+            notetype = notetypes[notetype_id] = self.mw.col.models.get(notetype_id)
         if not notetype:
             raise AnkiError(tr.ai_generation_error_invalid_notetype())
 
+        layout = layouts.get(notetype_id)
+        if layout is None:
+            layout = layouts[notetype_id] = FieldLayout.from_notetype(notetype)
+
         note = self.mw.col.new_note(notetype)
 
         field_map = {field.name.lower(): field.value for field in proto.fields}
-        for idx, field in enumerate(notetype["flds"]):
-            name = field["name"].lower()
-            value = field_map.pop(name, "")
-            note.fields[idx] = value
+        for idx, name in layout.fields:
+            note.fields[idx] = field_map.pop(name, "")
 
         if proto.source:
             source_value = self._format_source(proto.source)
-            self._assign_source_field(note, notetype, source_value)
+            self._assign_source_field(note, layout.source_index, source_value)
 
         # Append any remaining fields to the back field if present
         if field_map:
-            back_index = next(
-                (
-                    idx
-                    for idx, field in enumerate(notetype["flds"])
-                    if field["name"].lower() == "back"
-                ),
-                None,
-            )
+            back_index = layout.back_index
             if back_index is not None:
                 extras = [
                     value.strip() for value in field_map.values() if value.strip()
@@ -693,13 +824,16 @@ class AiGeneratorDialog(QDialog):
 
         return note, DeckId(deck_id)
 
-    def _assign_source_field(self, note: Note, notetype: dict, value: str) -> None:
-        for idx, field in enumerate(notetype["flds"]):
-            if field["name"].lower() == "source":
-                note.fields[idx] = value
-                return
+    def _assign_source_field(
+        self, note: Note, source_index: Optional[int], value: str
+    ) -> None:
+        if source_index is not None:
+            note.fields[source_index] = value
+            return
         # fallback: append to last field if Source not found
-        note.fields[-1] = (note.fields[-1] + "\n\n" + value).strip()
+        note.fields[-1] = "\n\n".join(
+            part for part in (note.fields[-1], value) if part
+        ).strip()
 
     def _format_source(self, source: ai_pb.GeneratedNoteSource) -> str:
         parts: List[str] = []
@@ -717,12 +851,9 @@ class AiGeneratorDialog(QDialog):
             parts.append(escape(source.title))
         return "<br>".join(parts)
 
-    def _on_add_success(self, indices: Iterable[int]) -> None:
-        indices_set = set(indices)
+    def _on_add_success(self, indices: frozenset[int]) -> None:
         self._generated_notes = [
-            note
-            for idx, note in enumerate(self._generated_notes)
-            if idx not in indices_set
+            note for idx, note in enumerate(self._generated_notes) if idx not in indices
         ]
         self._set_preview_notes(self._generated_notes)
         tooltip(tr.ai_generation_added_cards_tooltip(), parent=self)